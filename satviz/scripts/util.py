@@ -22,6 +22,7 @@
 
 # Contains few utility functions
 
+import shutil
 import ephem
 
 
@@ -194,10 +195,21 @@ def write_viz_files(viz_string, top_file, bottom_file, out_file):
     :param out_file: output HTML file
     :return: None
     """
-    writer_html = open(out_file, 'w')
-    with open(top_file, 'r') as fi:
-        writer_html.write(fi.read())
-    writer_html.write(viz_string)
-    with open(bottom_file, 'r') as fb:
-        writer_html.write(fb.read())
-    writer_html.close()
+    stream_viz_files(lambda writer_html: writer_html.write(viz_string), top_file, bottom_file, out_file)
+
+
+def stream_viz_files(write_viz, top_file, bottom_file, out_file):
+    """
+    Generates HTML visualization file, with the visualization written directly into it
+    :param write_viz: Function writing the HTML formatted visualization to the file object it is given
+    :param top_file: top part of the HTML file
+    :param bottom_file: bottom part of the HTML file
+    :param out_file: output HTML file
+    :return: None
+    """
+    with open(out_file, 'w') as writer_html:
+        with open(top_file, 'r') as fi:
+            shutil.copyfileobj(fi, writer_html)
+        write_viz(writer_html)
+        with open(bottom_file, 'r') as fb:
+            shutil.copyfileobj(fb, writer_html)
@@ -22,7 +22,9 @@
 
 import math
 import ephem
+import numpy as np
 import pandas as pd
+from sgp4.api import Satrec, SatrecArray, WGS72, jday
 
 try:
     from . import util
@@ -39,6 +41,7 @@ ARG_OF_PERIGEE_DEGREE = 0.0
 PHASE_DIFF = True
 EPOCH = "2000-01-01 00:00:00"
 UTIL_INTERVAL = 100
+JIT_MIN_ROWS = 1000000  # Below this many utilization rows, importing and compiling numba costs more than it saves
 
 # CONSTELLATION SPECIFIC PARAMETERS
 """
@@ -122,137 +125,268 @@ IN_UTIL_FILE = "../../paper/ns3_experiments/traffic_matrix/runs/run_general_tm_p
 
 # Output directory for creating visualization html files
 OUT_DIR = "../viz_output/"
-OUT_HTML_FILE = OUT_DIR + NAME + "_path_wise_util"
+
+# Templates of the generated Cesium entities
+SAT_TMPL = "var redSphere = viewer.entities.add({{name : '', position: Cesium.Cartesian3.fromDegrees(" \
+           "{lon:.6f}, {lat:.6f}, {alt:.0f}), ellipsoid : {{radii : new Cesium.Cartesian3(20000.0, 20000.0, 20000.0), " \
+           "material : Cesium.Color.BLACK.withAlpha(1),}}}});\n"
+ORBIT_LINK_TMPL = "viewer.entities.add({{name : '', polyline: {{ positions: Cesium.Cartesian3.fromDegreesArrayHeights([" \
+                  "{lon1:.6f},{lat1:.6f},{alt1:.0f},{lon2:.6f},{lat2:.6f},{alt2:.0f}]), " \
+                  "width: 0.1, arcType: Cesium.ArcType.NONE, material: new Cesium.PolylineOutlineMaterialProperty({{ " \
+                  "color: Cesium.Color.GREY.withAlpha(0.2), outlineWidth: 0, outlineColor: Cesium.Color.BLACK}})}}}});"
+PATH_LINK_TMPL = "viewer.entities.add({{name : '', polyline: {{ positions: Cesium.Cartesian3.fromDegreesArrayHeights([" \
+                 "{lon1:.6f},{lat1:.6f},{alt1:.0f},{lon2:.6f},{lat2:.6f},{alt2:.0f}]), " \
+                 "width: {width}, arcType: Cesium.ArcType.NONE, material: new Cesium.PolylineOutlineMaterialProperty({{ " \
+                 "color: Cesium.Color.fromCssColorString('#{col}'), outlineWidth: 0, outlineColor: Cesium.Color.BLACK}})}}}});"
+HEX = tuple(f"{i:02x}" for i in range(256))  # Two-digit hex of each 8-bit color channel value
 
 sat_objs = []
+satrec_array = None
+orbit_link_sat1 = np.empty(0, dtype=np.int32)
+orbit_link_sat2 = np.empty(0, dtype=np.int32)
 city_details = {}
 paths_over_time = []
-time_wise_util = {}
+link_ids = {}
+util_arr = None
 
 
-def generate_utilization_at_time():
+def _shifted_time(time_ms):
     """
-    Generates link utilization for a specific end-end path at specified time
-    :return: HTML formatted string for visualization
+    Converts a time offset into an absolute time
+    :param time_ms: Time since EPOCH in ms
+    :return: Shifted time
+    """
+    return pd.to_datetime(EPOCH) + pd.to_timedelta(time_ms, unit='ms')
+
+
+def _build_satrec_array(sat_objs):
+    """
+    Builds a batched SGP4 propagator from the orbital elements of the satellite objects
+    :param sat_objs: List of satellite objects
+    :return: SatrecArray covering all satellites, in the same order
+    """
+    sgp4_epoch = float(ephem.Date("1949/12/31 00:00:00"))  # SGP4 epochs are in days since this instant
+    satrecs = []
+    for i in range(len(sat_objs)):
+        sat = sat_objs[i]["sat_obj"]
+        satrec = Satrec()
+        satrec.sgp4init(
+            WGS72,
+            'i',
+            i,
+            float(sat._epoch) - sgp4_epoch,
+            0.0, 0.0, 0.0,  # No drag
+            sat._e,
+            float(sat._ap),
+            float(sat._inc),
+            float(sat._M),
+            sat._n * 2 * math.pi / 1440.0,  # Revolutions per day to radians per minute
+            float(sat._raan)
+        )
+        satrecs.append(satrec)
+    return SatrecArray(satrecs)
+
+
+def _propagate(satrec_array, time_ms):
+    """
+    Computes the sub-satellite points of all satellites
+    :param satrec_array: Batched SGP4 propagator of the satellites
+    :param time_ms: Time since EPOCH in ms
+    :return: (longitudes, latitudes) in degrees, indexed by satellite id
+    """
+    shifted_time = _shifted_time(time_ms)
+    jd, fr = jday(shifted_time.year, shifted_time.month, shifted_time.day,
+                  shifted_time.hour, shifted_time.minute, shifted_time.second + shifted_time.microsecond / 1e6)
+    _, pos_teme, _ = satrec_array.sgp4(np.array([jd]), np.array([fr]))
+    x, y, z = pos_teme[:, 0, 0], pos_teme[:, 0, 1], pos_teme[:, 0, 2]
+
+    # Greenwich mean sidereal time (IAU 1982) rotates TEME into the Earth-fixed frame
+    tut1 = (jd + fr - 2451545.0) / 36525.0
+    gmst_sec = 67310.54841 + (876600.0 * 3600 + 8640184.812866 + (0.093104 - 6.2e-6 * tut1) * tut1) * tut1
+    gmst = math.radians(gmst_sec / 240.0) % (2 * math.pi)
+    lon_rad = (np.arctan2(y, x) - gmst + math.pi) % (2 * math.pi) - math.pi
+    lat_rad = np.arctan2(z, np.hypot(x, y))  # Geocentric, as pyephem's sublat
+
+    # Both coordinates converted to degrees in one pass
+    sub_points = np.rad2deg(np.stack((lon_rad, lat_rad)))
+    return sub_points[0], sub_points[1]
+
+
+def _fill_util_buckets(util_arr, link_idx, start_bucket, num_intervals, utils):
+    """
+    Writes the utilization of each row into the consecutive time buckets it covers
+    :param util_arr: (link, time bucket) utilization table to fill
+    :param link_idx: Link index of each row
+    :param start_bucket: First time bucket of each row
+    :param num_intervals: Number of time buckets covered by each row
+    :param utils: Utilization of each row
+    :return: None
+    """
+    for i in range(len(link_idx)):
+        util_arr[link_idx[i], start_bucket[i]:start_bucket[i] + num_intervals[i]] = utils[i]
+
+
+def _compile_fill_util_buckets():
+    """
+    Compiles _fill_util_buckets with numba, if available; the compiled kernel is cached on disk across runs
+    :return: Compiled fill function, or the plain Python one if numba is not installed
+    """
+    try:
+        from numba import njit
+    except ImportError:
+        return _fill_util_buckets
+    return njit(cache=True)(_fill_util_buckets)
+
+
+def _render_orbit_links(lon, lat, alt_m, links):
+    """
+    Renders the orbit links between satellites
+    :param lon: Satellite longitudes in degrees
+    :param lat: Satellite latitudes in degrees
+    :param alt_m: Satellite altitudes in metres
+    :param links: (2, n) array holding the two endpoints of each orbit link
+    :return: HTML formatted string for the orbit links
+    """
+    sat1, sat2 = links
+    return "".join(
+        ORBIT_LINK_TMPL.format(lon1=lon1, lat1=lat1, alt1=alt1, lon2=lon2, lat2=lat2, alt2=alt2)
+        for lon1, lat1, alt1, lon2, lat2, alt2 in zip(
+            lon[sat1].tolist(), lat[sat1].tolist(), alt_m[sat1].tolist(),
+            lon[sat2].tolist(), lat[sat2].tolist(), alt_m[sat2].tolist()
+        )
+    )
+
+
+def select_path_at_time():
+    """
+    Selects the end-end path active at specified time
+    :return: Selected path as list of node ids, output HTML file name
     """
-    viz_string = ""
-    global src_GS
-    global dst_GS
     global paths_over_time
-    global OUT_HTML_FILE
-    lines = [line.rstrip('\n') for line in open(path_file)]
-    for i in range(len(lines)):
-        val = lines[i].split(",")
-        nodes = val[1].split("-")
-        paths_over_time.append((int(val[0]), nodes))
-    paths_over_time.append((0, nodes))
-    SEL_PATH_TIME = 0
-    SEL_PATH = []
-    for i in range(len(paths_over_time)):
-        start_ms = round((paths_over_time[i][0]) / 1000000)
-        start_next = 99999999999
-        try:
-            start_next = round((paths_over_time[i + 1][0]) / 1000000)
-        except:
-            None
-        print(start_ms, GEN_TIME)
-        if GEN_TIME >= start_ms and GEN_TIME < start_next:
-            SEL_PATH_TIME = paths_over_time[i][0]
-            SEL_PATH = paths_over_time[i][1]
-            break
+    paths_df = pd.read_csv(path_file, header=None, names=["t_ns", "nodes"], dtype={"t_ns": np.int64, "nodes": str})
+    paths_over_time = list(zip(paths_df["t_ns"].tolist(), paths_df["nodes"].str.split("-").tolist()))
+    path_start_ms = paths_df["t_ns"].to_numpy() // 1000000
+    # Path active at GEN_TIME is the last one that started at or before it
+    idx = np.searchsorted(path_start_ms, GEN_TIME, side="right") - 1
+    if idx < 0:
+        raise ValueError(f"No path active at GEN_TIME = {GEN_TIME} ms in {path_file}")
+    SEL_PATH_TIME, SEL_PATH = paths_over_time[idx]
     print(SEL_PATH_TIME, SEL_PATH)
 
-    global time_wise_util
-    lines = [line.rstrip('\n') for line in open(IN_UTIL_FILE)]
-    for i in range(len(lines)):
-        val = lines[i].split(",")
-        src = int(val[0])
-        dst = int(val[1])
-        start_ms = round(int(val[2]) / 1000000)
-        end_ms = round(int(val[3]) / 1000000)
-        utilization = float(val[4])
-        if utilization > 1.0:
-            SystemError("Util exceeded 1.0")
-        interval = 0  # millisecond
-        while interval < end_ms - start_ms:
-            time_wise_util[src, dst, start_ms + interval, start_ms + interval + UTIL_INTERVAL] = utilization
-            interval += UTIL_INTERVAL
-
-    shifted_epoch = (pd.to_datetime(EPOCH) + pd.to_timedelta(GEN_TIME, unit='ms')).strftime(format='%Y/%m/%d %H:%M:%S.%f')
-    print(shifted_epoch)
+    endpoint_labels = []
+    for node in (SEL_PATH[0], SEL_PATH[-1]):
+        GS = int(node) - NUM_ORBS*NUM_SATS_PER_ORB
+        print(city_details[GS]["name"])
+        endpoint_labels.append(f"{city_details[GS]['name']}_{node}")
+    out_html_file = f"{OUT_DIR}{NAME}_path_wise_util_{endpoint_labels[0]}_{endpoint_labels[1]}_{GEN_TIME}.html"
+    return SEL_PATH, out_html_file
+
+
+def load_utilization(sel_path):
+    """
+    Loads link utilization and resolves it for the satellite-satellite hops of an end-end path at specified time
+    :param sel_path: End-end path as list of node ids
+    :return: Hop source satellite ids, hop destination satellite ids, hop utilization quantized to 0-255
+    """
+    global link_ids
+    global util_arr
+    util_df = pd.read_csv(
+        IN_UTIL_FILE,
+        header=None,
+        names=["src", "dst", "start_ns", "end_ns", "util"],
+        dtype={"src": np.int32, "dst": np.int32, "start_ns": np.int64, "end_ns": np.int64, "util": np.float32}
+    )
+    if (util_df["util"] > 1.0).any():
+        raise ValueError("Util exceeded 1.0")
+    start_ms = (util_df["start_ns"] // 1000000).to_numpy()
+    end_ms = (util_df["end_ns"] // 1000000).to_numpy()
+
+    # Utilization is stored as a (link, time bucket) table, bucket b covering [b, b + 1) * UTIL_INTERVAL,
+    # quantized to 0-255 as it only drives 8-bit colors and link widths
+    link_pairs, link_idx = np.unique(util_df[["src", "dst"]].to_numpy(), axis=0, return_inverse=True)
+    link_idx = link_idx.ravel()
+    link_ids = {(src, dst): i for i, (src, dst) in enumerate(link_pairs.tolist())}
+
+    # Each row covers ceil((end - start) / UTIL_INTERVAL) consecutive buckets
+    start_bucket = start_ms // UTIL_INTERVAL
+    num_intervals = -(-(end_ms - start_ms) // UTIL_INTERVAL)
+    util_q = np.clip(np.round(util_df["util"].to_numpy() * 255), 0, 255).astype(np.uint8)
+    util_arr = np.zeros((len(link_pairs), (start_bucket + num_intervals).max()), dtype=np.uint8)
+    fill_util_buckets = _compile_fill_util_buckets() if len(util_df) >= JIT_MIN_ROWS else _fill_util_buckets
+    fill_util_buckets(util_arr, link_idx, start_bucket, num_intervals, util_q)
+
+    # Satellite-satellite hops of the path, utilization of a hop being the maximum over both directions
+    path_nodes = np.array(sel_path, dtype=np.int64)
+    hop_sat1 = path_nodes[1:-2].tolist()
+    hop_sat2 = path_nodes[2:-1].tolist()
+    util_bucket = (GEN_TIME - UTIL_INTERVAL) // UTIL_INTERVAL
+    if not 0 <= util_bucket < util_arr.shape[1]:
+        raise ValueError(
+            f"No utilization for interval [{GEN_TIME - UTIL_INTERVAL}, {GEN_TIME}) ms; GEN_TIME must be within "
+            f"[{UTIL_INTERVAL}, {util_arr.shape[1] * UTIL_INTERVAL}] ms for this utilization file"
+        )
+    hop_link_fwd = np.array([link_ids[sat1, sat2] for sat1, sat2 in zip(hop_sat1, hop_sat2)], dtype=np.int64)
+    hop_link_rev = np.array([link_ids[sat2, sat1] for sat1, sat2 in zip(hop_sat1, hop_sat2)], dtype=np.int64)
+    hop_util = np.maximum(util_arr[hop_link_fwd, util_bucket], util_arr[hop_link_rev, util_bucket]).astype(np.int32)
+    return hop_sat1, hop_sat2, hop_util
+
+
+def generate_utilization_at_time(out_fh, hop_sat1, hop_sat2, hop_util):
+    """
+    Generates link utilization for a specific end-end path at specified time
+    :param out_fh: File object the HTML formatted visualization is written to
+    :param hop_sat1: Source satellite id of each hop of the path
+    :param hop_sat2: Destination satellite id of each hop of the path
+    :param hop_util: Utilization of each hop of the path, quantized to 0-255
+    :return: None
+    """
+    print(_shifted_time(GEN_TIME).strftime(format='%Y/%m/%d %H:%M:%S.%f'))
+
+    lon, lat = _propagate(satrec_array, GEN_TIME)
+    alt_m = np.array([s["alt_km"] * 1000 for s in sat_objs])
 
     for i in range(len(sat_objs)):
-        sat_objs[i]["sat_obj"].compute(shifted_epoch)
-        viz_string += "var redSphere = viewer.entities.add({name : '', position: Cesium.Cartesian3.fromDegrees(" \
-                     + str(math.degrees(sat_objs[i]["sat_obj"].sublong)) + ", " \
-                     + str(math.degrees(sat_objs[i]["sat_obj"].sublat)) + ", "+str(sat_objs[i]["alt_km"]*1000)+"), "\
-                     + "ellipsoid : {radii : new Cesium.Cartesian3(20000.0, 20000.0, 20000.0), "\
-                     + "material : Cesium.Color.BLACK.withAlpha(1),}});\n"
+        out_fh.write(SAT_TMPL.format(lon=lon[i], lat=lat[i], alt=alt_m[i]))
+
+    out_fh.write(_render_orbit_links(lon, lat, alt_m, np.stack((orbit_link_sat1, orbit_link_sat2))))
+
+    link_width = 1 + 5 * hop_util / 255
+    # Green to yellow up to half utilization, yellow to red above
+    red_weight = np.minimum(2 * hop_util, 255)
+    green_weight = np.minimum(2 * (255 - hop_util), 255)
+    for sat1, sat2, width, red, green in zip(
+            hop_sat1, hop_sat2, link_width.tolist(), red_weight.tolist(), green_weight.tolist()
+    ):
+        out_fh.write(PATH_LINK_TMPL.format(
+            lon1=lon[sat1], lat1=lat[sat1], alt1=alt_m[sat1], lon2=lon[sat2], lat2=lat[sat2], alt2=alt_m[sat2],
+            width=width, col=HEX[red] + HEX[green] + "00"
+        ))
+
 
+if __name__ == "__main__":
+    city_details = util.read_city_details(city_details, city_detail_file)
+    sat_objs = util.generate_sat_obj_list(
+        NUM_ORBS,
+        NUM_SATS_PER_ORB,
+        EPOCH,
+        PHASE_DIFF,
+        INCLINATION_DEGREE,
+        ECCENTRICITY,
+        ARG_OF_PERIGEE_DEGREE,
+        MEAN_MOTION_REV_PER_DAY,
+        ALTITUDE_M
+    )
+    satrec_array = _build_satrec_array(sat_objs)
+    # Orbit links are static for a constellation, so their endpoints are resolved once
     orbit_links = util.find_orbit_links(sat_objs, NUM_ORBS, NUM_SATS_PER_ORB)
-    for key in orbit_links:
-        sat1 = orbit_links[key]["sat1"]
-        sat2 = orbit_links[key]["sat2"]
-        viz_string += "viewer.entities.add({name : '', polyline: { positions: Cesium.Cartesian3.fromDegreesArrayHeights([" \
-                      + str(math.degrees(sat_objs[sat1]["sat_obj"].sublong)) + "," \
-                      + str(math.degrees(sat_objs[sat1]["sat_obj"].sublat)) + "," \
-                      + str(sat_objs[sat1]["alt_km"] * 1000) + "," \
-                      + str(math.degrees(sat_objs[sat2]["sat_obj"].sublong)) + "," \
-                      + str(math.degrees(sat_objs[sat2]["sat_obj"].sublat)) + "," \
-                      + str(sat_objs[sat2]["alt_km"] * 1000) + "]), " \
-                      + "width: 0.1, arcType: Cesium.ArcType.NONE, " \
-                      + "material: new Cesium.PolylineOutlineMaterialProperty({ " \
-                      + "color: Cesium.Color.GREY.withAlpha(0.2), outlineWidth: 0, outlineColor: Cesium.Color.BLACK})}});"
-    for p in range(len(SEL_PATH)):
-        if p == 0 or p == len(SEL_PATH) - 1:
-            GS = int(SEL_PATH[p]) - NUM_ORBS*NUM_SATS_PER_ORB
-            print(city_details[GS]["name"])
-            OUT_HTML_FILE += "_"+city_details[GS]["name"] + "_" +str(SEL_PATH[p])
-        if 0 < p < len(SEL_PATH) - 2:
-            #print(SEL_PATH[p], SEL_PATH[p+1])
-            sat1 = int(SEL_PATH[p])
-            sat2 = int(SEL_PATH[p+1])
-            util_1 = time_wise_util[sat1, sat2, GEN_TIME - UTIL_INTERVAL, GEN_TIME]
-            util_2 = time_wise_util[sat2, sat1, GEN_TIME - UTIL_INTERVAL, GEN_TIME]
-            utilization = util_1
-            if util_2 > utilization:
-                utilization = util_2
-            link_width = 1 + 5 * utilization
-            if utilization >= 0.5:
-                red_weight = 255
-                green_weight = 0 + round(255 * (1 - utilization) / 0.5)
-            else:
-                green_weight = 255
-                red_weight = 255 - round(255 * (0.5 - utilization) / 0.5)
-            hex_col = '%02x%02x%02x' % (red_weight, green_weight, 0)
-            #print(sat1, sat2, util, hex_col)
-            viz_string += "viewer.entities.add({name : '', polyline: { positions: Cesium.Cartesian3.fromDegreesArrayHeights([" \
-                          + str(math.degrees(sat_objs[sat1]["sat_obj"].sublong)) + "," \
-                          + str(math.degrees(sat_objs[sat1]["sat_obj"].sublat)) + "," \
-                          + str(sat_objs[sat1]["alt_km"] * 1000) + "," \
-                          + str(math.degrees(sat_objs[sat2]["sat_obj"].sublong)) + "," \
-                          + str(math.degrees(sat_objs[sat2]["sat_obj"].sublat)) + "," \
-                          + str(sat_objs[sat2]["alt_km"] * 1000) + "]), " \
-                          + "width: " + str(link_width) + ", arcType: Cesium.ArcType.NONE, " \
-                          + "material: new Cesium.PolylineOutlineMaterialProperty({ " \
-                          + "color: Cesium.Color.fromCssColorString('#" + str(
-                hex_col) + "'), outlineWidth: 0, outlineColor: Cesium.Color.BLACK})}});"
-
-    OUT_HTML_FILE += "_" + str(GEN_TIME) + ".html"
-    return viz_string
-
-
-city_details = util.read_city_details(city_details, city_detail_file)
-sat_objs = util.generate_sat_obj_list(
-    NUM_ORBS,
-    NUM_SATS_PER_ORB,
-    EPOCH,
-    PHASE_DIFF,
-    INCLINATION_DEGREE,
-    ECCENTRICITY,
-    ARG_OF_PERIGEE_DEGREE,
-    MEAN_MOTION_REV_PER_DAY,
-    ALTITUDE_M
-)
-viz_string = generate_utilization_at_time()
-util.write_viz_files(viz_string, topFile, bottomFile, OUT_HTML_FILE)
+    orbit_link_sat1 = np.fromiter((orbit_links[key]["sat1"] for key in orbit_links), dtype=np.int32, count=len(orbit_links))
+    orbit_link_sat2 = np.fromiter((orbit_links[key]["sat2"] for key in orbit_links), dtype=np.int32, count=len(orbit_links))
+    SEL_PATH, OUT_HTML_FILE = select_path_at_time()
+    # Loaded before the output file is opened, so invalid input does not leave a truncated visualization behind
+    HOP_SAT1, HOP_SAT2, HOP_UTIL = load_utilization(SEL_PATH)
+    util.stream_viz_files(
+        lambda out_fh: generate_utilization_at_time(out_fh, HOP_SAT1, HOP_SAT2, HOP_UTIL),
+        topFile,
+        bottomFile,
+        OUT_HTML_FILE
+    )